@@ -1,25 +1,97 @@
 import numpy as np
 import pandas as pd
-import yfinance as yfinance
+import yfinance as yf
+import os
 import re
-from datetime import datetime as dt
+import io
+import csv
+import calendar
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
+from pathlib import Path
+import pypdfium2 as pdfium
 from docling.document_converter import DocumentConverter, PdfFormatOption
 from docling.datamodel.base_models import InputFormat
 from docling.datamodel.pipeline_options import PdfPipelineOptions
 from docling.backend.pypdfium2_backend import PyPdfiumDocumentBackend
+try:
+    from numba import njit
+except ImportError:  # numba is optional, _eom_rows falls back to _eom_rows_numpy
+    njit = None
+
+# header row of each stock table segment in a statement parsed to markdown
+_STOCK_HEADER_RE = re.compile(
+    r"^[|]\s+Symbol\s+[|]\s+Name\s+[|]\s+Quantity\s+[|]\s+Price on ", re.MULTILINE)
+# row that closes a stock table segment: either the totals row or an empty line
+_STOCK_SEG_END_RE = re.compile(r"^(?:[|][^\S\n]{2,}|$)", re.MULTILINE)
+
+# month names as they appear in statement dates mapped to their month numbers
+_MONTHS = {'January': '01', 'February': '02', 'March': '03', 'April': '04',
+           'May': '05', 'June': '06', 'July': '07', 'August': '08',
+           'September': '09', 'October': '10', 'November': '11', 'December': '12'}
+# statement date formatted like January 31, 2024 (any case and spacing, like strptime)
+_STATEMENT_DATE_RE = re.compile(r"(" + "|".join(_MONTHS) + r")\s+(\d{1,2}),\s+(\d{4})",
+                                re.IGNORECASE)
+
+# where price histories downloaded from yahoo finance are saved
+_HISTORY_CACHE_DIR = Path(__file__).parent / ".cache"
+
+
+@lru_cache(maxsize=4)
+def _get_converter(do_ocr, do_table_structure):
+    """ Builds a docling DocumentConverter for pdfs using the pypdfium2 backend.
+    Cached so the models are only loaded once per set of pipeline options
+    instead of on every call to parse_vang_pdf.
 
+    Args:
+      do_ocr (bool): set True if you suspect any scanned/image pages
+      do_table_structure (bool): set True to enable table extraction
+
+    Returns:
+      docling.document_converter.DocumentConverter
+    """
+    pipeline_options = PdfPipelineOptions(
+        do_ocr=do_ocr,
+        do_table_structure=do_table_structure
+    )
+
+    converter = DocumentConverter(
+        format_options={
+            InputFormat.PDF: PdfFormatOption(
+                pipeline_options=pipeline_options,
+                backend=PyPdfiumDocumentBackend
+            )
+        }
+    )
 
-def parse_vang_pdf(pdf_path, return_type='markdown'):
+    return converter
+
+
+def parse_vang_pdf(pdf_path, return_type='markdown', fast=False,
+                   do_table_structure=True):
     """ Parses a Vanguard monthly PDF statement and returns a result
     specified by return_type (default is markdown)
 
     Args:
       pdf_path (str): path to the pdf statement file to be parsed
       return_type (str): type of file to be returned (default: markdown)
+      fast (bool): if True, skip the docling pipeline and pull the text layer
+        straight out of the pdf with pypdfium2. Much faster on text-native
+        statements, but tables come back as plain text lines rather than
+        markdown tables so the table segment functions won't find them.
+        Useful when only the text is needed e.g. get_vang_statement_date
+        (default: False)
+      do_table_structure (bool): if True, run docling's table structure model
+        so tables are exported as markdown tables. This is the slowest part of
+        the docling pipeline. Set False when the stock and transaction tables
+        aren't needed (default: True)
 
     Return:
       str: the file specified by pdf_path in the format specified by
-      return_type
+      return_type. With fast=True this is the plain text of each page rather
+      than markdown with tables. An empty string is returned for any
+      return_type that isn't supported
 
     Prerequisites:
         The following docling modules must be available in the environment:
@@ -28,22 +100,30 @@ def parse_vang_pdf(pdf_path, return_type='markdown'):
         docling.datamodel.base_models.InputFormat
         docling.datamodel.pipeline_options.PdfPipelineOptions
         docling.backend.pypdfium2_backend.PyPdfiumDocumentBackend
+        pypdfium2 (used directly when fast=True)
     """
-    
-    pipeline_options = PdfPipelineOptions(
-        do_ocr=False,  # Set True if you suspect any scanned/image pages
-        do_table_structure=True  # Enables table extraction
-    )
-
-    converter = DocumentConverter(
-        format_options={
-            InputFormat.PDF: PdfFormatOption(
-                pipeline_options=pipeline_options,
-                backend=PyPdfiumDocumentBackend
-            )
-        }
-    )
-
+    if fast:
+        if return_type != 'markdown':  # TODO add other types
+            return ""
+        pdf = pdfium.PdfDocument(pdf_path)
+        pdf_text = io.StringIO()
+        try:
+            # one page at a time, closing each page as soon as its text is
+            # copied so only a single page is ever held in memory
+            for page_index, page in enumerate(pdf):
+                text_page = page.get_textpage()
+                if page_index > 0:
+                    pdf_text.write('\n')
+                pdf_text.write(text_page.get_text_bounded())
+                text_page.close()
+                page.close()
+        finally:
+            pdf.close()
+        # pdfium separates lines with \r\n
+        result_converted = pdf_text.getvalue().replace('\r\n', '\n')
+        return result_converted
+
+    converter = _get_converter(do_ocr=False, do_table_structure=do_table_structure)
     result = converter.convert(pdf_path)
     result_converted = ""
     if return_type == 'markdown':
@@ -53,6 +133,48 @@ def parse_vang_pdf(pdf_path, return_type='markdown'):
     return result_converted
 
 
+def parse_vang_pdfs(pdf_paths, n_workers=None, return_type='markdown', fast=False,
+                    do_table_structure=True):
+    """ Parses a list of Vanguard monthly PDF statements in parallel using
+    a pool of worker processes
+
+    Args:
+      pdf_paths (list[str]): paths to the pdf statement files to be parsed
+      n_workers (int): number of worker processes, default: half the cpus
+      return_type (str): type of file to be returned (default: markdown)
+      fast (bool): passed to parse_vang_pdf (default: False)
+      do_table_structure (bool): passed to parse_vang_pdf (default: True)
+
+    Return:
+      list[str]: result of parse_vang_pdf for each file in pdf_paths, in
+      the same order as pdf_paths
+
+    Note:
+      Workers are started with the spawn method so scripts calling this
+      need an if __name__ == '__main__': guard
+    """
+    if n_workers is None:
+        n_workers = max(1, (os.cpu_count() or 2) // 2)
+    parse_pdf = partial(parse_vang_pdf, return_type=return_type, fast=fast,
+                        do_table_structure=do_table_structure)
+    # OpenMP reads OMP_NUM_THREADS when its runtime starts, so limit each worker
+    # to one thread by setting it in the environment the workers are spawned
+    # with. Forked workers would inherit the parent's already started runtime.
+    omp_num_threads = os.environ.get('OMP_NUM_THREADS')
+    os.environ['OMP_NUM_THREADS'] = '1'
+    try:
+        with ProcessPoolExecutor(max_workers=n_workers,
+                                 mp_context=multiprocessing.get_context('spawn')) as executor:
+            parsed_statements = list(executor.map(parse_pdf, pdf_paths))
+    finally:
+        if omp_num_threads is None:
+            del os.environ['OMP_NUM_THREADS']
+        else:
+            os.environ['OMP_NUM_THREADS'] = omp_num_threads
+
+    return parsed_statements
+
+
 def get_vang_statement_date(parsed_statement_as_markdown,
                             id_text="Total value of all accounts as of "):
     """ Extracts the end-of-month statement date from a Vanguard monthly PDF
@@ -67,63 +189,106 @@ def get_vang_statement_date(parsed_statement_as_markdown,
       str: end-of-month statement date in YYYY-MM-DD format
     
     """
-    report_lines = parsed_statement_as_markdown.split('\n')
     statement_date_line = "DATE NOT FOUND!!!"
-    for line in report_lines:
-        line_has_date = id_text in line
-        if line_has_date:
-            statement_date_line = line
-            break
-
-    # get the date in YYYY-MM-DD format
-    statement_date = statement_date_line.replace(id_text, "")
-    statement_date = dt.strptime(statement_date, "%B %d, %Y")
-    statement_date = statement_date.strftime("%Y-%m-%d")
+    date_pos = 0  # position of the date in statement_date_line
+    # only pull out the line with id_text rather than splitting the whole report
+    id_pos = parsed_statement_as_markdown.find(id_text)
+    if id_pos >= 0:
+        line_start = parsed_statement_as_markdown.rfind('\n', 0, id_pos) + 1
+        line_end = parsed_statement_as_markdown.find('\n', id_pos)
+        if line_end < 0:
+            line_end = len(parsed_statement_as_markdown)
+        statement_date_line = parsed_statement_as_markdown[line_start:line_end]
+        date_pos = id_pos - line_start + len(id_text)
+
+    # get the date in YYYY-MM-DD format, it must directly follow id_text
+    date_match = _STATEMENT_DATE_RE.match(statement_date_line, date_pos)
+    if date_match is None:
+        raise ValueError(f"no statement date found in: {statement_date_line}")
+    year, month, day = (int(date_match[3]), _MONTHS[date_match[1].capitalize()],
+                        int(date_match[2]))
+    if not 1 <= day <= calendar.monthrange(year, int(month))[1]:
+        raise ValueError(f"invalid statement date in: {statement_date_line}")
+    statement_date = f"{year}-{month}-{day:02d}"
 
     return statement_date
 
 
+def _scoped_pattern(regex):
+    """ Wraps a regular expression in a group for use in an alternation, keeping
+    the ignore case, dot all and verbose flags of a compiled pattern local to
+    its own group
+
+    Args:
+      regex (str | re.Pattern): regular expression to be wrapped
+
+    Returns:
+      str: regex as a non-capturing group
+    """
+    if isinstance(regex, str):
+        return f"(?:{regex})"
+    scoped_flags = "".join(flag_char for flag, flag_char in
+                           ((re.IGNORECASE, 'i'), (re.DOTALL, 's'), (re.VERBOSE, 'x'))
+                           if regex.flags & flag)
+    return f"(?{scoped_flags}:{regex.pattern})"
+
+
 def get_vang_stock_table_segs(report_lines,
                               file_type = 'markdown',
-                              header_regex = r"^[|]\s+Symbol\s+[|]\s+Name\s+[|]\s+Quantity\s+[|]\s+Price on "):
+                              header_regex = _STOCK_HEADER_RE):
     """ Finds the row numbers of the start and end of each STOCK table segment
     in report_lines
 
     Args:
       report_lines (list[str]): list of strings that are lines from the parsed pdf report
       file_type (str): file type to be processed, default: markdown
-      header_regex (str): regular expression identifying the header row of each stock table segment
-        in the statement
+      header_regex (str | re.Pattern | list): regular expression identifying the header row
+        of each stock table segment in the statement. Always matched with re.MULTILINE.
+        A list of regular expressions (str or compiled) matches headers from any of them e.g. when the header
+        differs across statement vintages (default: precompiled _STOCK_HEADER_RE)
 
     Returns:
       tuple of 2-tuples: First item in each tuple is the row number of first row
       of a stock table segment. Second item in each tuple is the row number of the
       last row of a stock table segment
     """
-    stock_table_headers = []
-    stock_table_last_lines = []
-    found_table_header = False
-    for position, line in enumerate(report_lines):
-        header_search_result = re.search(header_regex, line)
-        if header_search_result is not None:                # found table header
-            found_table_header = True
-            stock_table_headers.append((position, header_search_result))
-        elif found_table_header and re.match(r"^[|]\s[A-Z]+", line):  # row of table segment
-            continue
-        elif found_table_header and re.match(r"^[|]\s{2,}", line):  # last row with totals
-            stock_table_last_lines.append(position - 1)
+    joined_lines = "\n".join(report_lines)
+    # offset of the first character of each line in joined_lines so that
+    # match offsets can be mapped back to row numbers
+    line_lengths = np.fromiter((len(line) + 1 for line in report_lines),
+                               dtype=np.int64, count=len(report_lines))
+    line_starts = np.cumsum(line_lengths) - line_lengths
+
+    # ^ has to match at the start of every line of joined_lines so patterns
+    # are always used with re.MULTILINE
+    if isinstance(header_regex, (list, tuple)):
+        # alternation so all the header variants are found in one scan
+        header_regex = re.compile("|".join(_scoped_pattern(regex) for regex in header_regex),
+                                  re.MULTILINE)
+    elif isinstance(header_regex, str):
+        header_regex = re.compile(header_regex, re.MULTILINE)
+    elif not header_regex.flags & re.MULTILINE:
+        header_regex = re.compile(header_regex.pattern, header_regex.flags | re.MULTILINE)
+    header_offsets = [m.start() for m in header_regex.finditer(joined_lines)]
+    header_indices = np.searchsorted(line_starts, header_offsets, side='right') - 1
+
+    table_segs = []
+    for header_index in header_indices:
+        if table_segs and header_index <= table_segs[-1][1]:
+            continue  # header inside a segment we already closed
+        seg_end = _STOCK_SEG_END_RE.search(joined_lines,
+                                           line_starts[header_index] +
+                                           line_lengths[header_index])
+        if seg_end is None:
             break
-        elif found_table_header and len(line) == 0:         # empty line after non-terminal table segment
-            # stock_table_last_lines.append(position - 1)
-            stock_table_last_lines.append(position)
-            found_table_header = False  # look for next segment
-
-    header_indices = [x[0] for x in stock_table_headers]
-    # print(f"header rows of table segments: {header_indices}")
-    # print(f"last rows of table segments: {stock_table_last_lines}")   
-    table_segs = tuple(zip(header_indices, stock_table_last_lines))
+        end_index = np.searchsorted(line_starts, seg_end.start(), side='right') - 1
+        if seg_end.group():                         # last row with totals
+            table_segs.append((int(header_index), int(end_index) - 1))
+            break
+        # empty line after non-terminal table segment
+        table_segs.append((int(header_index), int(end_index)))
 
-    return table_segs
+    return tuple(table_segs)
 
 
 def get_vang_trans_table_segs(report_lines,
@@ -308,6 +473,83 @@ def convert_md_table_rows_to_table_recs(table_lines, statement_date, record_func
     return table_row_recs
 
 
+def convert_md_stock_rows_to_df(table_lines, statement_date):
+    """ Converts a list of strings representing rows in a stock table to a
+    data frame. Produces the same records as convert_md_table_rows_to_table_recs
+    with make_vang_stock_record_dict, but all the rows are parsed in a single
+    pass of the pandas C parser instead of one row at a time.
+
+    Args:
+      table_lines (list[str]): rows of a stock table e.g. from
+        consolidate_md_table_chunks
+      statement_date (str): date of last day in the statement formatted YYYY-MM-DD
+
+    Returns:
+      pandas.core.frame.DataFrame: one row for each row in table_lines with
+      columns symbol, name, quantity, price_statement_eom, statement_date and
+      balance_statement_eom
+    
+    """
+    stock_dtypes = {'symbol': object, 'name': object, 'quantity': float,
+                    'price_statement_eom': float, 'balance_statement_eom': float}
+    if len(table_lines) == 0:
+        df_stock = pd.DataFrame({col: pd.Series(dtype=dtype)
+                                 for col, dtype in stock_dtypes.items()})
+        df_stock.insert(4, 'statement_date', pd.Series(dtype=object))
+        return df_stock
+
+    # remove the commas and $ chars from all the rows at once
+    table_blob = "\n".join(table_lines).replace(',', '').replace('$', '')
+    # no NA detection so blank and NA-like cells stay strings as they do in
+    # make_vang_stock_record_dict
+    df_stock = pd.read_csv(io.StringIO(table_blob), sep='|', engine='c',
+                           header=None, usecols=[1, 2, 3, 4, 6],
+                           names=list(stock_dtypes), dtype=stock_dtypes,
+                           keep_default_na=False, na_filter=False,
+                           quoting=csv.QUOTE_NONE, skipinitialspace=True)
+    # remove extra spaces right of the values
+    df_stock['symbol'] = df_stock['symbol'].str.rstrip()
+    df_stock['name'] = df_stock['name'].str.rstrip()
+    df_stock.insert(4, 'statement_date', statement_date)
+
+    return df_stock
+
+
+def _eom_rows_numpy(month_ids):
+    """ Finds the position of the last row of each month in month_ids
+
+    Args:
+      month_ids (numpy.ndarray): sorted int64 month ordinals (months since
+        1970-01), one for each row of daily prices
+
+    Returns:
+      numpy.ndarray: int64 positions of the last row of each month
+    """
+    if len(month_ids) == 0:
+        return np.empty(0, dtype=np.int64)
+    return np.append(np.flatnonzero(np.diff(month_ids)), len(month_ids) - 1)
+
+
+if njit is None:
+    _eom_rows = _eom_rows_numpy
+else:
+    @njit(cache=True)
+    def _eom_rows(month_ids):
+        """ Same as _eom_rows_numpy, compiled with numba to a single loop
+        over month_ids that doesn't allocate any temporary arrays
+        """
+        if month_ids.shape[0] == 0:
+            return np.empty(0, dtype=np.int64)
+        last_rows = np.empty(month_ids.shape[0], dtype=np.int64)
+        n_months = 0
+        for i in range(month_ids.shape[0] - 1):
+            if month_ids[i] != month_ids[i + 1]:
+                last_rows[n_months] = i
+                n_months += 1
+        last_rows[n_months] = month_ids.shape[0] - 1
+        return last_rows[:n_months + 1]
+
+
 def get_eomonth_price(df, start_month='2019-01', end_month='prior', price_col='Close'):
     """
     Determines the last day of every month in df['Date'] and returns a dataframe
@@ -332,52 +574,102 @@ def get_eomonth_price(df, start_month='2019-01', end_month='prior', price_col='C
     
     
     """
-    df_return = df.copy()
-    df_return['year'] = df_return.index.year.astype('string')
-    df_return['month'] = df_return.index.month.astype('string')
-    df_return['month'] = df_return['month'].str.zfill(2)  # zero pad
-    df_return['year_mo'] = df_return['year'] + '-' + df_return['month']
-    
-    # build date column, make it the index, drop the extra data column
-    df_return['day'] = df_return.index.day
-    df_return['date'] = df_return.index.date
-    df_return.index = df_return['date']
-    df_return.drop(['date'], axis=1, inplace=True)
-    
-    # convert index from datetime to string so we can join on it
-    df_return.index = df_return.index.astype('string')
-    df_price = df_return[[price_col, 'day', 'year_mo']]
-    
-    # find the last trading day of the month
-    df_id_eom = df_price.groupby('year_mo')['day'].max('day')
-    df_id_eom = pd.DataFrame(df_id_eom)
-    df_id_eom['date'] = df_id_eom.index + '-' + df_id_eom['day'].astype('string').str.zfill(2)
-    
-    # use df_id_oem to filter out all but last trading day of month
-    df_eom = df_price.merge(df_id_eom, on='date')
-    df_eom = df_eom[['date', price_col, 'year_mo']]
+    if not df.index.is_monotonic_increasing:
+        df = df.sort_index()
+    # dates are sorted so each month is a run of consecutive rows and the last
+    # trading day of the month is the last row of its run
+    dates = df.index
+    # monthly period ordinals (months since 1970-01) taken straight from the index
+    month_ids = ((dates.year - 1970) * 12 + dates.month - 1).to_numpy(dtype=np.int64)
+    eom_rows = _eom_rows(month_ids)
     
     # calc the prior month if needed
     if end_month == 'prior':
-        # get the current month so we can calc the prior month
-        end_month = str(dt.today().year) + "-" + \
-                    str(dt.today().month - 1).zfill(2)
-    # filter between start_month and end_month
-    df_return = df_eom.loc[(df_eom['year_mo'] >= start_month) & \
-                           (df_eom['year_mo'] <= end_month), :]
+        # period arithmetic rolls back a year in January
+        end_month = str(pd.Period.now('M') - 1)
+    # filter between start_month and end_month comparing month ordinals
+    eom_month_ids = month_ids[eom_rows]
+    in_range = (eom_month_ids >= pd.Period(start_month, 'M').ordinal) & \
+               (eom_month_ids <= pd.Period(end_month, 'M').ordinal)
+    eom_rows = eom_rows[in_range]
+    eom_dates = dates[eom_rows]
+    df_return = pd.DataFrame({
+        'date': eom_dates.strftime('%Y-%m-%d').astype('string'),
+        price_col: df[price_col].to_numpy()[eom_rows],
+        'year_mo': eom_dates.strftime('%Y-%m').astype('string')
+    }, index=np.flatnonzero(in_range))
     
     return(df_return)
 
 
+@lru_cache(maxsize=4)
+def _cached_history(ticker, start, end, interval):
+    """ Gets the price history of ticker from yahoo finance. Each history is
+    saved as a parquet file in _HISTORY_CACHE_DIR so it's only downloaded once
+    and is kept in memory after the first time it's read. Saving a history
+    deletes any saved histories of the same ticker, start and interval that
+    have a different end. Every call with the
+    same arguments gets the same DataFrame object, so callers must not modify
+    it in place (copy it first if needed).
+
+    Args:
+      ticker (str): yahoo finance ticker symbol e.g. ^SPX
+      start (str): first date of the history formatted YYYY-MM-DD
+      end (str): date after the last date of the history formatted YYYY-MM-DD
+      interval (str): yahoo finance data interval e.g. 1d
+
+    Returns:
+      pandas.core.frame.DataFrame: price history indexed by date
+
+    Raises:
+      ValueError: if yahoo finance returns no data, e.g. on a network error or
+        unknown ticker. Empty results are not cached.
+    """
+    cache_path = _HISTORY_CACHE_DIR / f"{ticker}_{start}_{end}_{interval}.parquet"
+    if cache_path.exists():
+        return pd.read_parquet(cache_path)
+
+    df_ticker = yf.Ticker(ticker).history(interval=interval, start=start, end=end,
+                                          auto_adjust=True, rounding=True)
+    if df_ticker.empty:
+        # yfinance logs download errors and returns an empty frame
+        raise ValueError(f"no price history returned for {ticker} "
+                         f"from {start} to {end}")
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    # older downloads of the same history are superseded by this one
+    for old_path in _HISTORY_CACHE_DIR.glob(f"{ticker}_{start}_*_{interval}.parquet"):
+        old_path.unlink()
+    df_ticker.to_parquet(cache_path)
+
+    return df_ticker
+
+
 def get_eomonth_sp500(start_month='2019-01', end_month='prior'):
     """
+    Gets the closing price of the S&P 500 (^SPX) on the last trading day of
+    each month from yahoo finance. Price histories are cached on disk so
+    repeated calls for the same months don't download the data again.
     
+    Args:
+    start_month (str): month of the form yyyy-mm designating the first month of
+        of prices to be returned
+    end_month (str): month of the form yyyy-mm designating the last month of
+        of prices to be returned or 'prior'. If 'prior' (default) is specified,
+        the month prior to the current month is used.
     
+    Returns:
+    pandas.core.frame.DataFrame from get_eomonth_price with the Close price
     
     """
-    spx = yf.Ticker("^SPX")
-    df_ticker = spx.history(period="max", interval="1d",
-                            start="2019-01-01", end="2024-05-02",
-                            auto_adjust=True, rounding=True)
+    if end_month == 'prior':
+        end_period = pd.Period.now('M') - 1
+    else:
+        end_period = pd.Period(end_month, 'M')
+    # history through the last day of end_month: yahoo finance's end is
+    # exclusive so use the first day of the following month. Keeps the cache
+    # key the same for every call asking for the same months.
+    end_date = (end_period + 1).start_time.strftime("%Y-%m-%d")
+    df_ticker = _cached_history("^SPX", start=start_month + "-01",
+                                end=end_date, interval="1d")
     
-    return(None)
+    return(get_eomonth_price(df_ticker, start_month, end_month))